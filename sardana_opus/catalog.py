@@ -0,0 +1,77 @@
+import sqlite3
+
+
+class AcquisitionCatalog(object):
+    """SQLite catalog of the OPUS acquisitions
+
+    One record is stored per acquisition so that spectra can be found by
+    temperature, stage position or time without listing the measurement
+    directory, e.g. all the spectra between 80 and 120 degC in a region:
+
+        catalog = AcquisitionCatalog('/data/opus_catalog.db')
+        catalog.query(temperature=(80, 120), x=(10, 12), y=(-1, 1))
+    """
+
+    COLUMNS = ("ref", "time", "temperature", "x", "y", "z", "mode", "exp",
+               "xpp", "scan_id")
+    RANGES = ("time", "temperature", "x", "y", "z")
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        # Allow queries from other processes while the controller writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS acquisition ("
+                "id INTEGER PRIMARY KEY, ref TEXT NOT NULL, time REAL, "
+                "temperature REAL, x REAL, y REAL, z REAL, mode INTEGER, "
+                "exp TEXT, xpp TEXT, scan_id INTEGER)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_temperature "
+                               "ON acquisition (temperature)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_position "
+                               "ON acquisition (x, y, z)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_time "
+                               "ON acquisition (time)")
+
+    def add(self, ref, time, temperature=None, x=None, y=None, z=None,
+            mode=None, exp=None, xpp=None, scan_id=None):
+        """Append the record of one acquisition"""
+        values = (ref, time, temperature, x, y, z, mode, exp, xpp, scan_id)
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO acquisition ({0}) VALUES ({1})".format(
+                    ", ".join(self.COLUMNS),
+                    ", ".join("?" * len(self.COLUMNS))),
+                values)
+
+    def query(self, **kwargs):
+        """Get the records matching all the given conditions, sorted by time.
+
+        time, temperature, x, y and z take a (min, max) tuple, inclusive,
+        where None leaves that side open. The other columns take a value.
+        """
+        conditions = []
+        params = []
+        for name, value in sorted(kwargs.items()):
+            if name not in self.COLUMNS:
+                raise ValueError("Unknown catalog column: {0}".format(name))
+            if name in self.RANGES:
+                low, high = value
+                if low is not None:
+                    conditions.append("{0} >= ?".format(name))
+                    params.append(low)
+                if high is not None:
+                    conditions.append("{0} <= ?".format(name))
+                    params.append(high)
+            else:
+                conditions.append("{0} = ?".format(name))
+                params.append(value)
+        sql = "SELECT {0} FROM acquisition".format(", ".join(self.COLUMNS))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY time"
+        return [dict(row) for row in self._conn.execute(sql, params)]
+
+    def close(self):
+        self._conn.close()
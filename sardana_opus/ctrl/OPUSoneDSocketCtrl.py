@@ -1,5 +1,8 @@
 import os
+import time
+import numpy
 import PyTango
+import taurus
 from sardana import State, DataAccess
 from sardana.pool.controller import (OneDController,
                                      Referable,
@@ -7,6 +10,35 @@ from sardana.pool.controller import (OneDController,
                                      Access,
                                      Description,
                                      DefaultValue)
+from sardana_opus.catalog import AcquisitionCatalog
+
+try:
+    from brukeropusreader import read_file as read_opus_file
+except ImportError:
+    read_opus_file = None
+
+
+def minmax_pyramid(data, levels):
+    """Min/max decimation of a spectrum at each of the given number of bins.
+
+    Returns a dict mapping each level to an array of 2 * level points with
+    the min and max of every bin interleaved, so that the envelope of the
+    full resolution spectrum is kept. Levels whose 2 * level points would
+    not be smaller than the spectrum map to the spectrum itself.
+    """
+    data = numpy.asarray(data, dtype=float).ravel()
+    pyramid = {}
+    for level in levels:
+        if 2 * level >= data.size:
+            pyramid[level] = data
+            continue
+        edges = numpy.linspace(0, data.size, level, endpoint=False)
+        edges = edges.astype(int)
+        preview = numpy.empty(2 * level)
+        preview[0::2] = numpy.minimum.reduceat(data, edges)
+        preview[1::2] = numpy.maximum.reduceat(data, edges)
+        pyramid[level] = preview
+    return pyramid
 
 
 class OPUSoneDSocketCtrl(OneDController, Referable):
@@ -21,6 +53,18 @@ class OPUSoneDSocketCtrl(OneDController, Referable):
                Description: 'Linkam Ds URI',
                DefaultValue: "bl01/ct/linkam"
                },
+        "catalog": {Type: str,
+               Description: 'SQLite acquisition catalog file (empty: disabled)',
+               DefaultValue: ""
+               },
+        "stage_motors": {Type: str,
+               Description: 'Comma separated x, y, z stage motors for the catalog',
+               DefaultValue: ""
+               },
+        "macro_server": {Type: str,
+               Description: 'MacroServer giving the catalog scan id (ScanID)',
+               DefaultValue: ""
+               },
     }
 
     axis_attributes = {
@@ -56,12 +100,36 @@ class OPUSoneDSocketCtrl(OneDController, Referable):
                       Description: 'Light intensity (for visible mode) 0 to 100',
                       Access: DataAccess.ReadWrite
                       },
+        "preview_width": {Type: int,
+                      Description: 'Display width of the min/max quick-look '
+                                   'value (0: no value, full data in file)',
+                      Access: DataAccess.ReadWrite
+                      },
+        "preview_256": {Type: (float,),
+                      Description: 'Min/max quick-look at 256 bins',
+                      Access: DataAccess.ReadOnly
+                      },
+        "preview_1024": {Type: (float,),
+                      Description: 'Min/max quick-look at 1024 bins',
+                      Access: DataAccess.ReadOnly
+                      },
+        "preview_4096": {Type: (float,),
+                      Description: 'Min/max quick-look at 4096 bins',
+                      Access: DataAccess.ReadOnly
+                      },
+        "scan_id": {Type: int,
+                      Description: 'Scan id stored in the catalog when no '
+                                   'macro_server is given',
+                      Access: DataAccess.ReadWrite
+                      },
     }
 
     ON = 1
     MOVING = 0
     IR = 0
     VISIBLE = 1
+    PREVIEW_LEVELS = (256, 1024, 4096)
+    PREVIEW_BLOCK = "AB"
 
     def __init__(self, inst, props, *args, **kwargs):
         super().__init__(inst, props, *args, **kwargs)
@@ -82,12 +150,37 @@ class OPUSoneDSocketCtrl(OneDController, Referable):
         self._add_temp2filename = False
         self._opus_mode = 0
         self._opus_cam_intensity = 100
+        self._preview_width = 0
+        self._pyramid = None
+        self._pyramid_file = None
+        self._warned_block = False
+        self._temp_name = ''
         
         try:
             self.linkam = PyTango.DeviceProxy(self.linkam_ds)
         except:
             self.linkam = None
 
+        self._scan_id = None
+        self._record = None
+        self._catalog = None
+        self._stage_motors = []
+        self._macro_server = None
+        if self.catalog:
+            try:
+                self._catalog = AcquisitionCatalog(self.catalog)
+                self._stage_motors = [
+                    PyTango.DeviceProxy(name.strip())
+                    for name in self.stage_motors.split(',') if name.strip()]
+                if self.macro_server:
+                    from sardana.taurus.core.tango.sardana import \
+                        registerExtensions
+                    registerExtensions()
+                    self._macro_server = taurus.Device(self.macro_server)
+            except:
+                self._log.error("Can not open catalog %s", self.catalog,
+                                exc_info=True)
+
     def ReadOne(self, ind):
         self._log.debug("ReadOne... {0}".format(self._state))
         value = None
@@ -97,27 +190,121 @@ class OPUSoneDSocketCtrl(OneDController, Referable):
                 self._log.debug("cmd output: {0}".format(output))
             except:
                 self._log.debug("Exception:", exc_info=True)
+        if self._preview_width > 0:
+            fitting = [level for level in self.PREVIEW_LEVELS
+                       if level <= self._preview_width]
+            value = self._get_preview(max(fitting) if fitting
+                                      else min(self.PREVIEW_LEVELS))
         return value
 
+    def _get_preview(self, level):
+        if self._pyramid_file is not None:
+            self._build_pyramid(self._pyramid_file)
+            self._pyramid_file = None
+        if self._pyramid is None:
+            return None
+        return self._pyramid[level]
+
+    def _build_pyramid(self, path):
+        """Compute the quick-look levels of the finished acquisition.
+
+        The spectrum is read once, on the first preview request, from the
+        OPUS file referenced by RefOne, where the full resolution data stays.
+        """
+        if read_opus_file is None:
+            self._log.error("brukeropusreader is needed for previews")
+            return
+        try:
+            data = read_opus_file(path)
+            if self.PREVIEW_BLOCK not in data:
+                if not self._warned_block:
+                    self._log.warning("No %s block in %s, no previews",
+                                      self.PREVIEW_BLOCK, path)
+                    self._warned_block = True
+                return
+            npt = len(data.get_range(self.PREVIEW_BLOCK))
+            spectrum = data[self.PREVIEW_BLOCK][:npt]
+            self._pyramid = minmax_pyramid(spectrum, self.PREVIEW_LEVELS)
+        except:
+            self._log.error("Can not read spectrum from %s", path,
+                            exc_info=True)
+
+    def _file_path(self):
+        name = '{0}{1}'.format(self._opus_nam, self._temp_name)
+        if self._opus_mode == self.IR:
+            # OPUS adds the file number, take_snapshot does not
+            name += '.0'
+        return os.path.join(self._opus_pth, name)
+
     def RefOne(self, axis):
-        name = '{0}{1}.0'.format(self._opus_nam, self._temp_name)
-        fullpath = os.path.join(self._opus_pth, name)
-        return 'file://{}'.format(fullpath)
+        return 'file://{}'.format(self._file_path())
 
     def StateOne(self, ind):
         self._log.debug("StateOne...")
         state = self._opusds.state()
         if state is PyTango.DevState.ON:
             state = State.On
+            if self._opus_macro_is_running:
+                if self._opus_mode == self.IR:
+                    # Previews are built on request from this file
+                    self._pyramid_file = self._file_path()
+                if self._record is not None:
+                    self._add_record(ind)
             self._opus_macro_is_running = False
         elif state is PyTango.DevState.RUNNING:
             state = State.Moving
         elif state is PyTango.DevState.ALARM:
             state = State.Fault
+            # Do not catalog a failed acquisition
+            self._record = None
         status = self._opusds.status()
         self._log.debug("StateOne... {0}, {1}".format(state, status))
         return state, status
 
+    def _read_field(self, name, read):
+        """Read one catalog field, None if it can not be read"""
+        try:
+            return read()
+        except:
+            self._log.error("Can not read %s for the catalog", name,
+                            exc_info=True)
+            return None
+
+    def _prepare_record(self):
+        """Collect the acquisition conditions to be stored in the catalog"""
+        temperature = None
+        if self._add_temp2filename and self.linkam and self._opus_nam != '':
+            # Already read for this acquisition filename in PreStartOne
+            temperature = self._linkam_temp
+        elif self.linkam:
+            temperature = self._read_field(
+                "temperature",
+                lambda: self.linkam.read_attribute("temperature").value)
+        position = [self._read_field(
+                        motor.dev_name(),
+                        lambda: motor.read_attribute("position").value)
+                    for motor in self._stage_motors]
+        position += [None] * (3 - len(position))
+        x, y, z = position[:3]
+        scan_id = self._scan_id
+        if self._macro_server is not None:
+            scan_id = self._read_field(
+                "scan id",
+                lambda: self._macro_server.getEnvironment("ScanID"))
+        self._record = {"time": time.time(), "temperature": temperature,
+                        "x": x, "y": y, "z": z,
+                        "mode": self._opus_mode, "exp": self._opus_exp,
+                        "xpp": self._opus_xpp, "scan_id": scan_id}
+
+    def _add_record(self, axis):
+        """Append the finished acquisition to the catalog"""
+        record, self._record = self._record, None
+        try:
+            self._catalog.add(self.RefOne(axis), **record)
+        except:
+            self._log.error("Can not add acquisition to catalog",
+                            exc_info=True)
+
     def StartAll(self):
         self._log.debug("StartAll")
 
@@ -136,12 +323,18 @@ class OPUSoneDSocketCtrl(OneDController, Referable):
         self._opus_cmd += "}});"
         self._opus_cmd = self._opus_cmd.format(self._opus_exp, self._opus_xpp)
         self._log.debug("PreStartOne... {}".format(self._opus_cmd))
+        if self._catalog is not None:
+            self._prepare_record()
 
         return True #self._opusds.connect()
 
     def StartOne(self, axis, value=None):
         self._log.debug("StartOne")
         self._opus_macro_is_running = True
+        self._pyramid = None
+        self._pyramid_file = None
+        if self._record is not None:
+            self._record["time"] = time.time()
         if self._opus_mode == self.IR:
             self._opusds.runOpusCMD(self._opus_cmd)
         elif self._opus_mode == self.VISIBLE:
@@ -154,6 +347,7 @@ class OPUSoneDSocketCtrl(OneDController, Referable):
         pass
 
     def AbortOne(self, ind):
+        self._record = None
         self._opusds.stopOpusMacro()
 
     def GetAxisExtraPar(self, axis, name):
@@ -175,6 +369,16 @@ class OPUSoneDSocketCtrl(OneDController, Referable):
             return self._opus_mode
         elif name.lower() == "opus_cam_intensity":
             return self._opus_cam_intensity
+        elif name.lower() == "preview_width":
+            return self._preview_width
+        elif name.lower() == "preview_256":
+            return self._get_preview(256)
+        elif name.lower() == "preview_1024":
+            return self._get_preview(1024)
+        elif name.lower() == "preview_4096":
+            return self._get_preview(4096)
+        elif name.lower() == "scan_id":
+            return self._scan_id
 
     def SetAxisExtraPar(self, axis, name, value):
         if name.lower() == "ds":
@@ -210,6 +414,10 @@ class OPUSoneDSocketCtrl(OneDController, Referable):
             if self._opus_mode == self.VISIBLE:
                 cmd = "COMMAND_LINE SendCommand(0,+{{UNI='MOT56={}'}});".format(lintensity)
                 self._opusds.runOpusCMDSync(cmd)
+        elif name.lower() == "preview_width":
+            self._preview_width = value
+        elif name.lower() == "scan_id":
+            self._scan_id = value
 
     #def SetAxisPar(self, axis, parameter, value):
         #if parameter == "value_ref_pattern":
@@ -1,3 +1,4 @@
+import math
 import time
 import PyTango
 from sardana.pool.controller import (MotorController,
@@ -7,6 +8,67 @@ from sardana.pool.controller import (MotorController,
                                      DefaultValue)
 from sardana import State, DataAccess
 
+
+def _trapezoid(distance, velocity, acc_time):
+    """Acceleration, acceleration time, peak velocity and constant velocity
+    time of a trapezoidal move over the given distance"""
+    if acc_time <= 0:
+        return float('inf'), 0, velocity, distance / velocity
+    acc = velocity / acc_time
+    t_acc = min(acc_time, math.sqrt(distance / acc))
+    v_peak = acc * t_acc
+    return acc, t_acc, v_peak, (distance - v_peak * t_acc) / v_peak
+
+
+def trapezoidal_position(start, target, velocity, acc_time, elapsed):
+    """Position of a trapezoidal move from start to target after elapsed
+    seconds, using the Sardana convention of acceleration given as the time
+    to reach the nominal velocity. Moves too short to reach it follow a
+    triangular profile.
+    """
+    distance = abs(target - start)
+    if elapsed <= 0:
+        return start
+    if distance == 0 or velocity <= 0 or \
+            elapsed >= trapezoidal_duration(distance, velocity, acc_time):
+        return target
+    sign = 1 if target > start else -1
+    acc, t_acc, v_peak, t_flat = _trapezoid(distance, velocity, acc_time)
+    if elapsed < t_acc:
+        done = 0.5 * acc * elapsed ** 2
+    elif elapsed < t_acc + t_flat:
+        done = 0.5 * v_peak * t_acc + v_peak * (elapsed - t_acc)
+    else:
+        remaining = 2 * t_acc + t_flat - elapsed
+        done = distance - 0.5 * acc * remaining ** 2
+    return start + sign * done
+
+
+def trapezoidal_time(start, target, velocity, acc_time, position):
+    """Elapsed time at which a trapezoidal move from start to target goes
+    through position (inverse of trapezoidal_position)"""
+    distance = abs(target - start)
+    if distance == 0 or velocity <= 0:
+        return 0
+    done = min(max((position - start) / (target - start), 0), 1) * distance
+    acc, t_acc, v_peak, t_flat = _trapezoid(distance, velocity, acc_time)
+    d_acc = 0.5 * v_peak * t_acc
+    if done < d_acc:
+        return math.sqrt(2 * done / acc)
+    elif done <= distance - d_acc:
+        return t_acc + (done - d_acc) / v_peak
+    return 2 * t_acc + t_flat - math.sqrt(2 * (distance - done) / acc)
+
+
+def trapezoidal_duration(distance, velocity, acc_time):
+    """Total time of a trapezoidal move over the given distance"""
+    distance = abs(distance)
+    if distance == 0:
+        return 0
+    acc, t_acc, v_peak, t_flat = _trapezoid(distance, velocity, acc_time)
+    return 2 * t_acc + t_flat
+
+
 class OpusStageMotorController(MotorController):
     """The most basic controller to manage the Opus Tango Stage motors
     """
@@ -23,10 +85,28 @@ class OpusStageMotorController(MotorController):
                       Description: 'Axis name (x, y, or z)',
                       #Access: DataAccess.ReadWrite
                       },
+        "predict_position": {Type: bool,
+                             Description: 'Answer position reads during a '
+                                          'move from a trapezoidal model '
+                                          '(stage profile read once, set '
+                                          'again to re-read it). The state '
+                                          'is still queried at every poll',
+                             Access: DataAccess.ReadWrite
+                             },
+        "position_read_period": {Type: float,
+                                 Description: 'Min time (s) between real '
+                                              'position queries while '
+                                              'predicting',
+                                 Access: DataAccess.ReadWrite
+                                 },
     }
 
     MaxDevice = 3
 
+    # Position units per mm for each stage dimension (?dim) the motion
+    # model supports: 1 => um, 2 => mm
+    UNITS_PER_MM = {1: 1000.0, 2: 1.0}
+
     def __init__(self, inst, props, *args, **kwargs):
         """Constructor"""
         super(OpusStageMotorController, self).__init__(inst, props, *args,
@@ -39,20 +119,85 @@ class OpusStageMotorController(MotorController):
             self._opusds = None
             self._state = State.Fault
         self.attributes = {}
+        self._moves = {}
+        self._profiles = {}
+        self._last_pos = {}
 
     def AddDevice(self, axis):
         self._log.debug('AddDevice entering...')
         self.attributes[axis] = {'step_per_unit': 1.0,
                                  'base_rate': 0,
                                  'acceleration': 0,
-                                 'velocity': 1}
+                                 'velocity': 1,
+                                 'predict_position': False,
+                                 'position_read_period': 1.0}
+
     def DeleteDevice(self, axis):
         self.attributes[axis] = None
+        self._moves.pop(axis, None)
+        self._profiles.pop(axis, None)
+        self._last_pos.pop(axis, None)
 
 
     def ReadOne(self, axis):
-        self._log.debug("In ReadOne axis %d" % axis)
         """Get the motor position"""
+        self._log.debug("In ReadOne axis %d" % axis)
+        move = self._moves.get(axis)
+        if move is not None:
+            now = time.time()
+            period = self.attributes[axis]["position_read_period"]
+            if now < move["end_time"] and \
+                    now - move["last_read"] < period:
+                pos = trapezoidal_position(move["start"], move["target"],
+                                           move["velocity"],
+                                           move["acc_time"],
+                                           now - move["start_time"])
+                self._last_pos[axis] = pos
+                self._log.debug("Out ReadOne axis %d [%s] (predicted)"
+                                % (axis, str(pos)))
+                return pos
+            move["last_read"] = now
+            pos = self._read_position(axis)
+            if not math.isinf(pos):
+                self._reanchor(move, pos, now)
+            return pos
+        return self._read_position(axis)
+
+    def _reanchor(self, move, pos, now):
+        """Correct the move model with a measured position"""
+        start, target = move["start"], move["target"]
+        if min(start, target) <= pos <= max(start, target):
+            # Shift the profile in time so that it goes through pos
+            elapsed = trapezoidal_time(start, target, move["velocity"],
+                                       move["acc_time"], pos)
+            move["start_time"] = now - elapsed
+            move["end_time"] = now + trapezoidal_duration(
+                target - start, move["velocity"], move["acc_time"]) - elapsed
+        else:
+            # Out of the modelled path: restart the profile from pos
+            move["start"] = pos
+            move["start_time"] = now
+            move["end_time"] = now + trapezoidal_duration(
+                target - pos, move["velocity"], move["acc_time"])
+
+    def _query(self, axis, cmd):
+        """Send a serial query for the axis and return the answer"""
+        return self._opusds.runOpusCMDSync("send_serial_cmd {0} {1}".format(
+            cmd, self.attributes[axis]["axis_name"]))
+
+    def _read_profile(self, axis):
+        """Read the velocity (units/s) and acceleration time (s) the stage
+        controller will use for the next move"""
+        dim = int(float(self._query(axis, "?dim")))
+        units_per_mm = self.UNITS_PER_MM[dim]
+        # ?vel in rev/s, ?pitch in mm/rev and ?accel in m/s2
+        velocity = float(self._query(axis, "?vel")) * \
+            float(self._query(axis, "?pitch")) * units_per_mm
+        acc = float(self._query(axis, "?accel")) * 1000 * units_per_mm
+        return velocity, velocity / acc if acc > 0 else 0
+
+    def _read_position(self, axis):
+        """Query the motor position to the Opus DS"""
         try:
             state = self._opusds.state()
             while state is not PyTango.DevState.ON:
@@ -66,6 +211,7 @@ class OpusStageMotorController(MotorController):
                 #    time.sleep(0.05)
                 #pos = float(self._opusds.getLastOpusOutput())
                 pos = float(ans)
+                self._last_pos[axis] = pos
         except Exception as e:
             self._log.debug("Error in ReadOne: %s" % e)
             pos = float('INF')
@@ -106,17 +252,55 @@ class OpusStageMotorController(MotorController):
             state = State.Moving
         elif state is PyTango.DevState.ALARM:
             state = State.Fault
+        if state != State.Moving:
+            # Move finished: next read queries the final position
+            self._moves.pop(axis, None)
         status = self._opusds.status()
         self._log.debug("StateOne... {0}, {1}".format(state, status))
         return state, status
 
     def StartOne(self, axis, position):
         """Move the motor to the specified position"""
+        self._moves.pop(axis, None)
+        if self.attributes[axis]["predict_position"]:
+            self._start_model(axis, position)
         self._opusds.runOpusCMDSync("send_serial_cmd !go {0} {1}".format(
             self.attributes[axis]["axis_name"], position))
 
+    def _start_model(self, axis, position):
+        """Model the move from the last known position with the stage
+        controller velocity and acceleration"""
+        start = self._last_pos.get(axis)
+        if start is None:
+            start = self._read_position(axis)
+        if math.isinf(start):
+            return
+        if axis not in self._profiles:
+            # The stage profile is not written by this controller: read it
+            # once, it is cleared when predict_position is set again
+            try:
+                self._profiles[axis] = self._read_profile(axis)
+            except Exception as e:
+                self._log.warning("Can not predict axis %d position: %s"
+                                  % (axis, e))
+                return
+        velocity, acc_time = self._profiles[axis]
+        if velocity <= 0:
+            return
+        now = time.time()
+        self._moves[axis] = {
+            "start": start,
+            "target": position,
+            "velocity": velocity,
+            "acc_time": acc_time,
+            "start_time": now,
+            "end_time": now + trapezoidal_duration(position - start,
+                                                   velocity, acc_time),
+            "last_read": now}
+
     def StopOne(self, axis):
         """Stop the specified motor"""
+        self._moves.pop(axis, None)
         self._opusds.runOpusCMDSync("send_serial_cmd ?abort {0}".format(
             self.attributes[axis]["axis_name"]))
 
@@ -140,6 +324,13 @@ class OpusStageMotorController(MotorController):
             self.attributes[axis]["base_rate"] = float(value)
         elif name.lower() == "axis_name":
             self.attributes[axis]["axis_name"] = value
+        elif name == "predict_position":
+            self.attributes[axis]["predict_position"] = bool(value)
+            self._profiles.pop(axis, None)
+            if not value:
+                self._moves.pop(axis, None)
+        elif name == "position_read_period":
+            self.attributes[axis]["position_read_period"] = float(value)
 
     def GetAxisExtraPar(self, axis, name):
         """ Get the standard pool motor parameters.
@@ -161,6 +352,10 @@ class OpusStageMotorController(MotorController):
             value = self.attributes[axis]["base_rate"]
         elif name.lower() == "axis_name":
             value = self.attributes[axis]["axis_name"]
+        elif name == "predict_position":
+            value = self.attributes[axis]["predict_position"]
+        elif name == "position_read_period":
+            value = self.attributes[axis]["position_read_period"]
 
 
         return value
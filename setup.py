@@ -29,5 +29,6 @@ setup(
     include_package_data=True,
     keywords="bruker,opus,sardana",
     python_requires=">=3.5",
-    install_requires=["sardana", "pytango"]
+    install_requires=["sardana", "pytango", "numpy"],
+    extras_require={"preview": ["brukeropusreader"]}
 )